@@ -37,6 +37,7 @@ ext_modules = [ ]
 if USE_CYTHON:
     ext_modules += [
         Extension("porepy.numerics.fv.cythoninvert", ["src/porepy/numerics/fv/invert_diagonal_blocks.pyx" ]),
+        Extension("porepy.numerics.fem.cythonp1", ["src/porepy/numerics/fem/p1_assemble.pyx" ]),
     ]
     cmdclass.update({ 'build_ext': build_ext })
 
@@ -1,7 +1,17 @@
+import sys
 import warnings
+import functools
 import numpy as np
 import scipy.sparse as sps
 import scipy.linalg as linalg
+try:
+    import numba
+except ImportError:
+    pass
+try:
+    import porepy.numerics.fem.cythonp1 as cythonp1
+except ImportError:
+    pass
 
 from porepy.grids import grid, mortar_grid
 
@@ -32,6 +42,8 @@ class P1(Solver):
 
     def __init__(self, physics='flow'):
         self.physics = physics
+        self.has_numba = 'numba' in sys.modules
+        self.has_cython = 'porepy.numerics.fem.cythonp1' in sys.modules
 
 #------------------------------------------------------------------------------#
 
@@ -100,8 +112,9 @@ class P1(Solver):
 
         Additional parameter:
         --------------------
-        bc_weight: to compute the infinity norm of the matrix and use it as a
-            weight to impose the boundary conditions. Default True.
+        bc_weight: to compute an upper bound of the infinity norm of the
+            matrix and use it as a weight to impose the boundary conditions.
+            Default True.
 
         Additional return:
         weight: if bc_weight is True return the weight computed.
@@ -129,62 +142,100 @@ class P1(Solver):
         # surface coordinates in 1d and 2d)
         c_centers, f_normals, f_centers, R, dim, node_coords = cg.map_grid(g)
 
+        perm = k.perm
         if not data.get('is_tangential', False):
-            # Rotate the permeability tensor and delete last dimension
+            # Rotate the permeability tensor and delete last dimension, by
+            # using only the rows of the rotation associated to the active
+            # dimensions (see SecondOrderTensor.rotate)
             if g.dim < 3:
-                k = k.copy()
-                k.rotate(R)
-                remove_dim = np.where(np.logical_not(dim))[0]
-                k.perm = np.delete(k.perm, (remove_dim), axis=0)
-                k.perm = np.delete(k.perm, (remove_dim), axis=1)
-
-        # Allocate the data to store matrix entries, that's the most efficient
-        # way to create a sparse matrix.
-        size = np.power(g.dim+1, 2)*g.num_cells
-        I = np.empty(size, dtype=np.int)
-        J = np.empty(size, dtype=np.int)
-        dataIJ = np.empty(size)
-        idx = 0
+                R = R[dim, :]
+                perm = np.einsum('ij,jkc,lk->lic', R, perm, R)
 
+        # Nodes of each cell, for simplices there are exactly g.dim+1 per cell
+        nodes_per_cell = g.dim+1
         cell_nodes = g.cell_nodes()
-        nodes, cells, _ = sps.find(cell_nodes)
-
-        for c in np.arange(g.num_cells):
-            # For the current cell retrieve its nodes
-            loc = slice(cell_nodes.indptr[c], cell_nodes.indptr[c+1])
-
-            nodes_loc = nodes[loc]
-            coord_loc = node_coords[:, nodes_loc]
-
-            # Compute the stiff-H1 local matrix
-            A = self.stiffH1(a[c]*k.perm[0:g.dim, 0:g.dim, c],
-                             g.cell_volumes[c], coord_loc, g.dim)
-
-            # Save values for stiff-H1 local matrix in the global structure
-            cols = np.tile(nodes_loc, (nodes_loc.size, 1))
-            loc_idx = slice(idx, idx+cols.size)
-            I[loc_idx] = cols.T.ravel()
-            J[loc_idx] = cols.ravel()
-            dataIJ[loc_idx] = A.ravel()
-            idx += cols.size
-
-        # Construct the global matrices
-        M = sps.csr_matrix((dataIJ, (I, J)))
-
-        norm = sps.linalg.norm(M, np.inf) if bc_weight else 1
+        nloc = cell_nodes.indices.reshape((g.num_cells, nodes_per_cell))
+
+        # Store the node coordinates node-wise, so that the coordinates of a
+        # node are contiguous in memory when gathered cell by cell
+        node_coords = np.ascontiguousarray(node_coords.T)
+
+        # Store the permeability, scaled with the aperture, cell-wise
+        K = np.moveaxis(perm[0:g.dim, 0:g.dim, :], 2, 0)
+        K = np.ascontiguousarray(K)*a[:, np.newaxis, np.newaxis]
+
+        # The sparsity pattern of the matrix depends only on the topology of
+        # the grid. It is stored in data, together with a buffer for the
+        # entries of the local matrices, and reused as long as the cell-node
+        # relation does not change. Subsequent assemblies skip the
+        # construction and the sorting of the indices.
+        ndof = self.ndof(g)
+        nloc_known, dataIJ, pos, indices, indptr = \
+            data.get('p1_assembly', (None,)*5)
+        if nloc_known is None or not np.array_equal(nloc_known, nloc):
+            # Indices of the stiff-H1 local matrices in the global structure
+            I = np.repeat(nloc, nodes_per_cell, axis=1).ravel()
+            J = np.broadcast_to(nloc[:, np.newaxis, :],
+                                (g.num_cells, nodes_per_cell, nodes_per_cell))
+            J = J.reshape(-1)
+
+            pos, indices, indptr = _csr_pattern(I, J, ndof)
+            dataIJ = np.empty(I.size)
+            data['p1_assembly'] = (nloc, dataIJ, pos, indices, indptr)
+
+        # Use numba if available, then cython, unless the problem is very
+        # small, in which case the numpy version is faster than combined
+        # compile and runtime for numba. The number 1000 here is somewhat
+        # random. The compiled versions stream through the cells without
+        # allocating any intermediate array.
+        if self.has_numba and g.num_cells > 1000:
+            _assemble_stiffH1_numba[g.dim](node_coords, nloc, K,
+                                           g.cell_volumes, dataIJ)
+        elif self.has_cython and g.num_cells > 1000:
+            # The cython kernel is compiled for int32 node indices
+            cythonp1.assemble_stiffH1(node_coords,
+                                      nloc.astype(np.int32, copy=False), K,
+                                      g.cell_volumes, dataIJ)
+        else:
+            # Compute the gradients of the basis functions for all the cells
+            # at once, by inverting the batch of local matrices [1, x_i] (see
+            # self.stiffH1 for the single cell version)
+            Q = np.ones((g.num_cells, nodes_per_cell, nodes_per_cell))
+            Q[:, :, 1:] = node_coords[nloc]
+            dphi = _inv_batch(Q)
+
+            # Compute all the stiff-H1 local matrices, the batched products
+            # are dispatched by matmul to compiled kernels
+            A = np.matmul(dphi.transpose(0, 2, 1), np.matmul(K, dphi))
+            np.multiply(A, g.cell_volumes[:, np.newaxis, np.newaxis],
+                        out=dataIJ.reshape(A.shape))
+
+        # Construct the global matrix by summing the local entries directly in
+        # the csr storage
+        M = sps.csr_matrix((np.bincount(pos, dataIJ, minlength=indices.size),
+                            indices.copy(), indptr.copy()), shape=(ndof, ndof))
+
+        # Upper bound of the infinity norm of the matrix, as the largest entry
+        # times the largest number of entries in a row. It is only used to
+        # scale the boundary conditions, thus the exact value is not needed
+        norm = 1
+        if bc_weight:
+            norm = np.abs(M.data).max()*np.diff(M.indptr).max()
 
         # assign the Dirichlet boundary conditions
         if bc and np.any(bc.is_dir):
-            nodes, _, _, = sps.find(g.face_nodes)
-
-            dir_nodes = np.array([\
-                         nodes[g.face_nodes.indptr[f]:g.face_nodes.indptr[f+1]]\
-                        for f in np.where(bc.is_dir)[0]]).ravel()
+            # Nodes of the Dirichlet faces, for simplices there are exactly
+            # g.dim per face
+            nodes_per_face = g.dim
+            dir_nodes = g.face_nodes.indices.reshape((-1, nodes_per_face))
+            dir_nodes = dir_nodes[bc.is_dir].ravel()
 
             # set in an efficient way the essential boundary conditions, by
-            # clear the rows and put norm in the diagonal
-            for row in dir_nodes:
-                M.data[M.indptr[row]:M.indptr[row+1]] = 0.
+            # clear the rows and put norm in the diagonal. The rows are cleared
+            # all at once by masking the entries of M.data row-wise
+            is_dir_row = np.zeros(M.shape[0], dtype=bool)
+            is_dir_row[dir_nodes] = True
+            M.data[np.repeat(is_dir_row, np.diff(M.indptr))] = 0.
 
             d = M.diagonal()
             d[dir_nodes] = norm
@@ -204,8 +255,9 @@ class P1(Solver):
 
         Additional parameter:
         --------------------
-        bc_weight: to use the infinity norm of the matrix to impose the
-            boundary conditions. Default 1.
+        bc_weight: to use the weight computed by self.matrix, an upper bound
+            of the infinity norm of the matrix, to impose the boundary
+            conditions. Default 1.
 
         """
         # Allow short variable names in backend function
@@ -233,48 +285,47 @@ class P1(Solver):
 
         if np.any(bc.is_dir):
             is_dir = np.where(bc.is_dir)[0]
-            nodes, _, _, = sps.find(g.face_nodes)
-
-            size = np.power(g.dim, 2)*is_dir.size
-            I = np.empty(size, dtype=np.int)
-            J = np.empty(size, dtype=np.int)
-            dataIJ = np.empty(size)
-            idx = 0
-
-            size_rhs = g.dim*is_dir.size
-            data_rhs = np.empty(size_rhs)
-            I_rhs = np.empty(size_rhs, dtype=np.int)
-            idx_rhs = 0
-
-            for f in is_dir:
-                loc = slice(g.face_nodes.indptr[f], g.face_nodes.indptr[f+1])
-                nodes_loc = nodes[loc]
-
-                A = self.massH1(g.face_areas[f], g.dim-1)
-                b = bc_weight*g.face_areas[f]*bc_val[f]/g.dim
-
-                # Save values for H1-mass local matrix in the global structure
-                cols = np.tile(nodes_loc, (nodes_loc.size, 1))
-                loc_idx = slice(idx, idx+cols.size)
-                I[loc_idx] = cols.T.ravel()
-                J[loc_idx] = cols.ravel()
-                dataIJ[loc_idx] = A.ravel()
-                idx += cols.size
-
-                loc_idx = slice(idx_rhs, idx_rhs+nodes_loc.size)
-                I_rhs[loc_idx] = nodes_loc
-                data_rhs[loc_idx] = b.ravel()
-                idx_rhs += nodes_loc.size
 
-            # Construct the global matrices
-            M = sps.csr_matrix((dataIJ, (I, J)), shape=(rhs.size, rhs.size))
-            identity = (M.sum(axis=1) == 0).astype(np.float).ravel()
-            M += sps.diags(identity, offsets=[0], shape=M.shape)
-
-            M_rhs = sps.csr_matrix((data_rhs, (I_rhs, np.zeros(I_rhs.size))),
-                                    shape=(rhs.size, 1))
-
-            rhs = sps.linalg.spsolve(M, M_rhs)
+            # Nodes of each Dirichlet face, for simplices there are exactly
+            # g.dim per face
+            nodes_per_face = g.dim
+            nloc = g.face_nodes.indices.reshape((-1, nodes_per_face))[is_dir]
+
+            areas = g.face_areas[is_dir]
+            b = bc_weight*areas*bc_val[is_dir]/g.dim
+            M_rhs = np.bincount(nloc.ravel(), np.repeat(b, nodes_per_face),
+                                minlength=rhs.size)
+
+            # The H1-mass matrix on the boundary depends only on the nodes and
+            # the areas of the Dirichlet faces, thus its factorization is
+            # stored in data and reused as long as they do not change
+            nloc_known, areas_known, size_known, solve = \
+                data.get('p1_dir_mass', (None,)*4)
+            if size_known != rhs.size or\
+               not np.array_equal(nloc_known, nloc) or\
+               not np.array_equal(areas_known, areas):
+                # The H1-mass local matrices are all the same up to the face
+                # area
+                A = areas[:, np.newaxis, np.newaxis]*_mass_template(g.dim-1)
+
+                # Save values for H1-mass local matrices in the global
+                # structure
+                I = np.repeat(nloc, nodes_per_face, axis=1).ravel()
+                J = np.broadcast_to(nloc[:, np.newaxis, :], A.shape)
+                J = J.reshape(-1)
+                dataIJ = A.ravel()
+
+                # Construct the global matrix, with the identity on the nodes
+                # not on the Dirichlet boundary
+                M = sps.coo_matrix((dataIJ, (I, J)),
+                                   shape=(rhs.size, rhs.size)).tocsr()
+                identity = (M.sum(axis=1) == 0).astype(np.float64).ravel()
+                M += sps.diags(identity, offsets=[0], shape=M.shape)
+
+                solve = sps.linalg.factorized(M.tocsc())
+                data['p1_dir_mass'] = (nloc, areas, rhs.size, solve)
+
+            rhs = solve(M_rhs)
 
         return rhs
 
@@ -289,6 +340,10 @@ class P1(Solver):
             Permeability of the cell.
         c_volume : scalar
             Cell volume.
+        coord : ndarray (g.dim, g.dim+1)
+            Coordinates of the nodes of the cell, in the reference geometry.
+        dim : int
+            Dimension of the cell.
 
         Return
         ------
@@ -298,8 +353,16 @@ class P1(Solver):
         # Allow short variable names in this function
         # pylint: disable=invalid-name
 
+        if self.has_numba:
+            if dim == 1:
+                return _stiffH1_1d(K, c_volume, coord)
+            elif dim == 2:
+                return _stiffH1_2d(K, c_volume, coord)
+            elif dim == 3:
+                return _stiffH1_3d(K, c_volume, coord)
+
         Q = np.hstack((np.ones((dim+1, 1)), coord.T))
-        dphi = np.linalg.inv(Q)[1:, :]
+        dphi = _inv_batch(Q[np.newaxis])[0]
 
         return c_volume*np.dot(dphi.T, np.dot(K, dphi))
 
@@ -321,8 +384,7 @@ class P1(Solver):
         # Allow short variable names in this function
         # pylint: disable=invalid-name
 
-        M = np.ones((dim+1, dim+1))+np.identity(dim+1)
-        return c_volume*M/((dim+1)*(dim+2))
+        return c_volume*_mass_template(dim)
 
 #------------------------------------------------------------------------------#
 
@@ -362,32 +424,33 @@ class P1Coupling(AbstractCoupling):
         mg = data_edge['mortar_grid']
         dof, cc = self.create_block_matrix([g_h, g_l, mg])
 
-        # Recover the information for the grid-grid mapping
-        faces_h, cells_h, _ = sps.find(g_h.cell_faces)
-        ind_faces_h = np.unique(faces_h, return_index=True)[1]
-        cells_h = cells_h[ind_faces_h]
-
-        # Mortar mass matrix
-        M = sps.diags(1./mg.cell_volumes)
+        # Recover the information for the grid-grid mapping, i.e. the first
+        # cell of each face, read directly from the face-wise storage
+        face_cells = g_h.cell_faces.tocsr()
+        face_cells.eliminate_zeros()
+        face_cells.sort_indices()
+        cells_h = face_cells.indices[face_cells.indptr[:-1]]
 
         # Projection matrix from hight/lower grid to mortar
         hat_P = mg.high_to_mortar_avg()
         check_P = mg.low_to_mortar_avg()
 
-        hat_P0 = g_h.face_nodes.T.astype(np.float)/g_h.dim
-        check_P0 = g_l.cell_nodes().T.astype(np.float)/(g_l.dim+1)
+        hat_P0 = g_h.face_nodes.T.astype(np.float64)/g_h.dim
+        check_P0 = g_l.cell_nodes().T.astype(np.float64)/(g_l.dim+1)
 
         # Normal permeability and aperture of the intersection
         inv_k = 1./(2.*data_edge['kn'])
         aperture_h = data_h['param'].get_aperture()
 
-        # Inverse of the normal permability matrix
-        Eta = sps.diags(np.divide(inv_k, hat_P*aperture_h[cells_h]))
+        # Inverse of the normal permability matrix, it is diagonal as the
+        # inverse of the mortar mass matrix so their product is computed
+        # directly on the diagonals
+        eta = np.divide(inv_k, hat_P*aperture_h[cells_h])
 
         # Compute the mortar variables rows
         cc[2, 0] = -hat_P*hat_P0
         cc[2, 1] = check_P*check_P0
-        cc[2, 2] = Eta*M
+        cc[2, 2] = sps.diags(eta/mg.cell_volumes, format='csr')
 
         # Compute the high dimensional grid coupled to mortar grid term
         cc[0, 2] = -cc[2, 0].T
@@ -396,3 +459,354 @@ class P1Coupling(AbstractCoupling):
         return matrix + cc
 
 #------------------------------------------------------------------------------#
+
+def _inv_batch(Q):
+    """ Compute, for a batch of local matrices Q = [1, x_i] where x_i are the
+    coordinates of the nodes of a simplex, the rows 1: of the inverses. These
+    are the gradients of the P1 basis functions. The inverses are computed in
+    closed form, which for these small matrices is much cheaper than
+    np.linalg.inv.
+
+    Parameters
+    ----------
+    Q : ndarray (num_cells, dim+1, dim+1)
+        Local matrices, with the first column equal to one.
+
+    Return
+    ------
+    dphi : ndarray (num_cells, dim, dim+1)
+        Gradients of the basis functions, column i refers to the node i.
+    """
+    n = Q.shape[-1]
+    if n == 2:
+        return _inv2_batch(Q)
+    elif n == 3:
+        return _inv3_batch(Q)
+    elif n == 4:
+        return _inv4_batch(Q)
+    return np.linalg.inv(Q)[:, 1:, :]
+
+#------------------------------------------------------------------------------#
+
+def _inv2_batch(Q):
+    """ Rows 1: of the inverse of a batch of 2x2 matrices [1, x_i], see
+    _inv_batch.
+    """
+    dphi = np.empty((Q.shape[0], 1, 2))
+    dphi[:, 0, 1] = 1./(Q[:, 1, 1] - Q[:, 0, 1])
+    dphi[:, 0, 0] = -dphi[:, 0, 1]
+    return dphi
+
+#------------------------------------------------------------------------------#
+
+def _inv3_batch(Q):
+    """ Rows 1: of the inverse of a batch of 3x3 matrices [1, x_i], see
+    _inv_batch. The edges departing from the first node are inverted with
+    the 2x2 adjugate formula.
+    """
+    e = Q[:, 1:, 1:] - Q[:, :1, 1:]
+    det = e[:, 0, 0]*e[:, 1, 1] - e[:, 0, 1]*e[:, 1, 0]
+
+    dphi = np.empty((Q.shape[0], 2, 3))
+    dphi[:, 0, 1] = e[:, 1, 1]/det
+    dphi[:, 1, 1] = -e[:, 1, 0]/det
+    dphi[:, 0, 2] = -e[:, 0, 1]/det
+    dphi[:, 1, 2] = e[:, 0, 0]/det
+    dphi[:, :, 0] = -dphi[:, :, 1] - dphi[:, :, 2]
+    return dphi
+
+#------------------------------------------------------------------------------#
+
+def _inv4_batch(Q):
+    """ Rows 1: of the inverse of a batch of 4x4 matrices [1, x_i], see
+    _inv_batch. The edges departing from the first node are inverted with
+    the 3x3 adjugate formula, written as cross products.
+    """
+    e = Q[:, 1:, 1:] - Q[:, :1, 1:]
+    dphi = np.empty((Q.shape[0], 3, 4))
+    dphi[:, :, 1] = np.cross(e[:, 1], e[:, 2])
+    dphi[:, :, 2] = np.cross(e[:, 2], e[:, 0])
+    dphi[:, :, 3] = np.cross(e[:, 0], e[:, 1])
+    det = np.einsum('cd,cd->c', e[:, 0], dphi[:, :, 1])
+
+    dphi[:, :, 1:] /= det[:, np.newaxis, np.newaxis]
+    dphi[:, :, 0] = -np.sum(dphi[:, :, 1:], axis=2)
+    return dphi
+
+#------------------------------------------------------------------------------#
+
+def _csr_pattern(I, J, ndof):
+    """ Compute the csr storage of a square sparse matrix given in coordinate
+    format, where the repeated entries are summed. Only the indices are used,
+    thus the storage can be reused for any values associated to I and J.
+
+    Parameters
+    ----------
+    I : ndarray
+        Row indices.
+    J : ndarray
+        Column indices, same size as I.
+    ndof : int
+        Size of the matrix.
+
+    Return
+    ------
+    pos : ndarray (I.size)
+        Position of each entry in the csr data, the data are obtained as
+        np.bincount(pos, values).
+    indices : ndarray (int32)
+        Column indices of the csr storage, sorted row-wise.
+    indptr : ndarray (int32, ndof+1)
+        Row pointers of the csr storage.
+    """
+    key = I.astype(np.int64)*ndof + J
+    order = np.argsort(key, kind='stable')
+    key = key[order]
+
+    # Mark the first occurrence of each entry
+    is_new = np.ones(key.size, dtype=bool)
+    is_new[1:] = key[1:] != key[:-1]
+
+    pos = np.empty(key.size, dtype=np.int64)
+    pos[order] = np.cumsum(is_new) - 1
+
+    key = key[is_new]
+    indices = (key % ndof).astype(np.int32)
+    indptr = np.zeros(ndof+1, dtype=np.int32)
+    indptr[1:] = np.cumsum(np.bincount(key // ndof, minlength=ndof))
+    return pos, indices, indptr
+
+#------------------------------------------------------------------------------#
+
+@functools.lru_cache(maxsize=8)
+def _mass_template(dim):
+    """ Local mass H1 matrix of a simplex of dimension dim and unit volume,
+    see P1.massH1. The array is cached and thus read-only.
+    """
+    M = np.ones((dim+1, dim+1))+np.identity(dim+1)
+    M /= (dim+1)*(dim+2)
+    M.setflags(write=False)
+    return M
+
+#------------------------------------------------------------------------------#
+
+if 'numba' in sys.modules:
+    @numba.njit(cache=True, fastmath=True)
+    def _stiffH1_1d(K, c_volume, coord):
+        """ Local stiffness H1 matrix of a segment, see P1.stiffH1. The
+        gradients of the basis functions are computed in closed form.
+        """
+        dphi = 1./(coord[0, 1] - coord[0, 0])
+
+        A = np.empty((2, 2))
+        A[0, 0] = A[1, 1] = c_volume*K[0, 0]*dphi*dphi
+        A[0, 1] = A[1, 0] = -A[0, 0]
+        return A
+
+    @numba.njit(cache=True, fastmath=True)
+    def _stiffH1_2d(K, c_volume, coord):
+        """ Local stiffness H1 matrix of a triangle, see P1.stiffH1. The
+        gradients of the basis functions are computed by cofactors.
+        """
+        dphi = np.empty((2, 3))
+        det = (coord[0, 1] - coord[0, 0])*(coord[1, 2] - coord[1, 0]) -\
+              (coord[0, 2] - coord[0, 0])*(coord[1, 1] - coord[1, 0])
+        for i in range(3):
+            j, l = (i+1) % 3, (i+2) % 3
+            dphi[0, i] = (coord[1, j] - coord[1, l])/det
+            dphi[1, i] = (coord[0, l] - coord[0, j])/det
+
+        A = np.empty((3, 3))
+        for i in range(3):
+            for j in range(3):
+                A[i, j] = c_volume*(\
+                    dphi[0, i]*(K[0, 0]*dphi[0, j] + K[0, 1]*dphi[1, j]) +\
+                    dphi[1, i]*(K[1, 0]*dphi[0, j] + K[1, 1]*dphi[1, j]))
+        return A
+
+    @numba.njit(cache=True, fastmath=True)
+    def _stiffH1_3d(K, c_volume, coord):
+        """ Local stiffness H1 matrix of a tetrahedron, see P1.stiffH1. The
+        gradients of the basis functions are computed by cofactors, i.e. cross
+        products of the edges departing from the first node.
+        """
+        e = np.empty((3, 3))
+        for i in range(3):
+            for d in range(3):
+                e[i, d] = coord[d, i+1] - coord[d, 0]
+
+        dphi = np.empty((3, 4))
+        for i in range(3):
+            j, l = (i+1) % 3, (i+2) % 3
+            dphi[0, i+1] = e[j, 1]*e[l, 2] - e[j, 2]*e[l, 1]
+            dphi[1, i+1] = e[j, 2]*e[l, 0] - e[j, 0]*e[l, 2]
+            dphi[2, i+1] = e[j, 0]*e[l, 1] - e[j, 1]*e[l, 0]
+        det = e[0, 0]*dphi[0, 1] + e[0, 1]*dphi[1, 1] + e[0, 2]*dphi[2, 1]
+        for d in range(3):
+            dphi[d, 1] /= det
+            dphi[d, 2] /= det
+            dphi[d, 3] /= det
+            dphi[d, 0] = -dphi[d, 1] - dphi[d, 2] - dphi[d, 3]
+
+        A = np.empty((4, 4))
+        for i in range(4):
+            for j in range(4):
+                val = 0.
+                for d1 in range(3):
+                    for d2 in range(3):
+                        val += dphi[d1, i]*K[d1, d2]*dphi[d2, j]
+                A[i, j] = c_volume*val
+        return A
+
+    @numba.njit(cache=True, parallel=True, fastmath=True)
+    def _assemble_d1(node_coords, nloc, K, c_volumes, dataIJ):
+        """ Compute the local stiffness H1 matrices of all the cells of a 1d
+        grid, and store them consecutively in dataIJ. The cells are treated in
+        parallel. The loops have fixed length and the local quantities are
+        kept in scalars, see also _assemble_d2 and _assemble_d3.
+
+        Parameters
+        ----------
+        node_coords : ndarray (g.num_nodes, g.dim)
+            Coordinates of the nodes, in the reference geometry.
+        nloc : ndarray (g.num_cells, g.dim+1)
+            Nodes of each cell.
+        K : ndarray (g.num_cells, g.dim, g.dim)
+            Permeability, scaled with the aperture, of each cell.
+        c_volumes : ndarray (g.num_cells)
+            Cell volumes.
+        dataIJ : ndarray ((g.dim+1)**2*g.num_cells)
+            Output array for the entries of the local matrices.
+        """
+        for c in numba.prange(nloc.shape[0]):
+            dphi = 1./(node_coords[nloc[c, 1], 0] - node_coords[nloc[c, 0], 0])
+            val = c_volumes[c]*K[c, 0, 0]*dphi*dphi
+
+            dataIJ[4*c] = val
+            dataIJ[4*c+1] = -val
+            dataIJ[4*c+2] = -val
+            dataIJ[4*c+3] = val
+
+    @numba.njit(cache=True, parallel=True, fastmath=True)
+    def _assemble_d2(node_coords, nloc, K, c_volumes, dataIJ):
+        """ Version of _assemble_d1 for triangles.
+        """
+        for c in numba.prange(nloc.shape[0]):
+            n0, n1, n2 = nloc[c, 0], nloc[c, 1], nloc[c, 2]
+
+            # Edges departing from the first node
+            e0x = node_coords[n1, 0] - node_coords[n0, 0]
+            e0y = node_coords[n1, 1] - node_coords[n0, 1]
+            e1x = node_coords[n2, 0] - node_coords[n0, 0]
+            e1y = node_coords[n2, 1] - node_coords[n0, 1]
+            inv_det = 1./(e0x*e1y - e0y*e1x)
+
+            # Gradients of the basis functions
+            dx1, dy1 = e1y*inv_det, -e1x*inv_det
+            dx2, dy2 = -e0y*inv_det, e0x*inv_det
+            dx = (-dx1-dx2, dx1, dx2)
+            dy = (-dy1-dy2, dy1, dy2)
+
+            k00, k01 = K[c, 0, 0], K[c, 0, 1]
+            k10, k11 = K[c, 1, 0], K[c, 1, 1]
+            for i in range(3):
+                kx = c_volumes[c]*(dx[i]*k00 + dy[i]*k10)
+                ky = c_volumes[c]*(dx[i]*k01 + dy[i]*k11)
+                for j in range(3):
+                    dataIJ[9*c+3*i+j] = kx*dx[j] + ky*dy[j]
+
+    @numba.njit(cache=True, parallel=True, fastmath=True)
+    def _assemble_d3(node_coords, nloc, K, c_volumes, dataIJ):
+        """ Version of _assemble_d1 for tetrahedra.
+        """
+        for c in numba.prange(nloc.shape[0]):
+            n0, n1 = nloc[c, 0], nloc[c, 1]
+            n2, n3 = nloc[c, 2], nloc[c, 3]
+
+            # Edges departing from the first node
+            e0x = node_coords[n1, 0] - node_coords[n0, 0]
+            e0y = node_coords[n1, 1] - node_coords[n0, 1]
+            e0z = node_coords[n1, 2] - node_coords[n0, 2]
+            e1x = node_coords[n2, 0] - node_coords[n0, 0]
+            e1y = node_coords[n2, 1] - node_coords[n0, 1]
+            e1z = node_coords[n2, 2] - node_coords[n0, 2]
+            e2x = node_coords[n3, 0] - node_coords[n0, 0]
+            e2y = node_coords[n3, 1] - node_coords[n0, 1]
+            e2z = node_coords[n3, 2] - node_coords[n0, 2]
+
+            # Gradients of the basis functions, by cross products of the edges
+            dx1, dy1, dz1 = e1y*e2z - e1z*e2y, e1z*e2x - e1x*e2z, \
+                            e1x*e2y - e1y*e2x
+            dx2, dy2, dz2 = e2y*e0z - e2z*e0y, e2z*e0x - e2x*e0z, \
+                            e2x*e0y - e2y*e0x
+            dx3, dy3, dz3 = e0y*e1z - e0z*e1y, e0z*e1x - e0x*e1z, \
+                            e0x*e1y - e0y*e1x
+            inv_det = 1./(e0x*dx1 + e0y*dy1 + e0z*dz1)
+
+            dx = (-(dx1+dx2+dx3)*inv_det, dx1*inv_det, dx2*inv_det,
+                  dx3*inv_det)
+            dy = (-(dy1+dy2+dy3)*inv_det, dy1*inv_det, dy2*inv_det,
+                  dy3*inv_det)
+            dz = (-(dz1+dz2+dz3)*inv_det, dz1*inv_det, dz2*inv_det,
+                  dz3*inv_det)
+
+            k00, k01, k02 = K[c, 0, 0], K[c, 0, 1], K[c, 0, 2]
+            k10, k11, k12 = K[c, 1, 0], K[c, 1, 1], K[c, 1, 2]
+            k20, k21, k22 = K[c, 2, 0], K[c, 2, 1], K[c, 2, 2]
+            for i in range(4):
+                kx = c_volumes[c]*(dx[i]*k00 + dy[i]*k10 + dz[i]*k20)
+                ky = c_volumes[c]*(dx[i]*k01 + dy[i]*k11 + dz[i]*k21)
+                kz = c_volumes[c]*(dx[i]*k02 + dy[i]*k12 + dz[i]*k22)
+                for j in range(4):
+                    dataIJ[16*c+4*i+j] = kx*dx[j] + ky*dy[j] + kz*dz[j]
+
+    # Assembly of the local stiffness H1 matrices, specialized by dimension
+    _assemble_stiffH1_numba = {1: _assemble_d1, 2: _assemble_d2,
+                               3: _assemble_d3}
+
+    @functools.lru_cache(maxsize=4)
+    def assemble_stiffH1_cfunc(dim):
+        """ Compile a C callable version of the assembly of the local stiffness
+        H1 matrices, see _assemble_d1, for grids of dimension dim.
+        It is meant for drivers written in C or numba which assemble many
+        times, since the call bypasses the python argument handling of
+        P1.matrix. The compiled function is cached.
+
+        The C signature is
+            void (int64 num_cells, int64 num_nodes, double* node_coords,
+                  int32* nloc, double* K, double* c_volumes, double* dataIJ)
+        where the arrays are C-contiguous with the shapes given in
+        _assemble_d1.
+
+        Parameters
+        ----------
+        dim : int
+            Dimension of the grid.
+
+        Return
+        ------
+        out: numba CFunc
+            The function pointer is out.address, and out.ctypes is a ctypes
+            wrapper of it.
+        """
+        n = dim+1
+        assemble_dim = _assemble_stiffH1_numba[dim]
+        double_p = numba.types.CPointer(numba.types.float64)
+        int_p = numba.types.CPointer(numba.types.int32)
+        signature = numba.types.void(numba.types.int64, numba.types.int64,
+                                     double_p, int_p, double_p, double_p,
+                                     double_p)
+
+        @numba.cfunc(signature)
+        def assemble(num_cells, num_nodes, node_coords, nloc, K, c_volumes,
+                     dataIJ):
+            assemble_dim(
+                numba.carray(node_coords, (num_nodes, dim)),
+                numba.carray(nloc, (num_cells, n)),
+                numba.carray(K, (num_cells, dim, dim)),
+                numba.carray(c_volumes, num_cells),
+                numba.carray(dataIJ, num_cells*n*n))
+
+        return assemble
+
+#------------------------------------------------------------------------------#
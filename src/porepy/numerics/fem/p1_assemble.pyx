@@ -0,0 +1,80 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True
+import numpy as np
+cimport numpy as np
+
+def assemble_stiffH1(double[:, ::1] node_coords, int[:, ::1] nloc,
+                     double[:, :, ::1] K, double[:] c_volumes,
+                     double[::1] dataIJ):
+    """
+    Compute the local stiffness H1 matrices of all the cells, and store them
+    consecutively in dataIJ. The cells are treated one at the time, the
+    gradients of the basis functions are computed in closed form and kept in
+    small local arrays, thus no intermediate array of the size of the grid is
+    allocated.
+
+    Parameters
+    ----------
+    node_coords : ndarray (g.num_nodes, g.dim)
+        Coordinates of the nodes, in the reference geometry.
+    nloc : ndarray (g.num_cells, g.dim+1)
+        Nodes of each cell.
+    K : ndarray (g.num_cells, g.dim, g.dim)
+        Permeability, scaled with the aperture, of each cell.
+    c_volumes : ndarray (g.num_cells)
+        Cell volumes.
+    dataIJ : ndarray ((g.dim+1)**2*g.num_cells)
+        Output array for the entries of the local matrices.
+    """
+
+    cdef Py_ssize_t num_cells = nloc.shape[0]
+    cdef Py_ssize_t n = nloc.shape[1]
+    cdef Py_ssize_t dim = n - 1
+    cdef Py_ssize_t c, i, j, d1, d2, idx
+
+    # Edges departing from the first node, and gradients of the basis
+    # functions of the current cell
+    cdef double e[3][3]
+    cdef double dphi[3][4]
+    cdef double det, val
+
+    for c in range(num_cells):
+        for i in range(dim):
+            for d1 in range(dim):
+                e[i][d1] = node_coords[nloc[c, i+1], d1] -\
+                           node_coords[nloc[c, 0], d1]
+
+        # Invert the matrix of the edges with the adjugate formula
+        if dim == 1:
+            dphi[0][1] = 1./e[0][0]
+        elif dim == 2:
+            det = e[0][0]*e[1][1] - e[0][1]*e[1][0]
+            dphi[0][1] = e[1][1]/det
+            dphi[1][1] = -e[1][0]/det
+            dphi[0][2] = -e[0][1]/det
+            dphi[1][2] = e[0][0]/det
+        else:
+            for i in range(3):
+                j, d2 = (i+1) % 3, (i+2) % 3
+                dphi[0][i+1] = e[j][1]*e[d2][2] - e[j][2]*e[d2][1]
+                dphi[1][i+1] = e[j][2]*e[d2][0] - e[j][0]*e[d2][2]
+                dphi[2][i+1] = e[j][0]*e[d2][1] - e[j][1]*e[d2][0]
+            det = e[0][0]*dphi[0][1] + e[0][1]*dphi[1][1] + e[0][2]*dphi[2][1]
+            for d1 in range(3):
+                for i in range(1, 4):
+                    dphi[d1][i] /= det
+
+        for d1 in range(dim):
+            dphi[d1][0] = 0.
+            for i in range(1, n):
+                dphi[d1][0] -= dphi[d1][i]
+
+        # Local stiffness matrix
+        idx = c*n*n
+        for i in range(n):
+            for j in range(n):
+                val = 0.
+                for d1 in range(dim):
+                    for d2 in range(dim):
+                        val += dphi[d1][i]*K[c, d1, d2]*dphi[d2][j]
+                dataIJ[idx] = c_volumes[c]*val
+                idx += 1
@@ -1,9 +1,13 @@
+import sys
+import ctypes
 import numpy as np
 import scipy.sparse as sps
 import unittest
 
 import porepy as pp
 from porepy import cg
+from porepy.grids import mortar_grid
+from porepy.numerics.fem import p1
 
 #------------------------------------------------------------------------------#
 
@@ -142,6 +146,91 @@ class BasicsTest(unittest.TestCase):
         assert np.allclose(M, M.T)
         assert np.allclose(M, M_known)
 
+#------------------------------------------------------------------------------#
+
+    @unittest.skipUnless('numba' in sys.modules, 'Numba not available')
+    def test_p1_3d_numba(self):
+
+        g = pp.simplex.StructuredTetrahedralGrid([8, 6, 6], [1, 1, 1])
+        g.nodes += 0.01*np.sin(7*g.nodes)
+        g.compute_geometry()
+
+        kxx = 1+np.square(g.cell_centers[0, :])
+        kxy = -np.multiply(g.cell_centers[0, :], g.cell_centers[1, :])
+        perm = pp.SecondOrderTensor(3, kxx=kxx, kyy=kxx, kzz=1, kxy=kxy)
+
+        bf = g.get_boundary_faces()
+        bc = pp.BoundaryCondition(g, bf, bf.size*['dir'])
+        solver = pp.P1(physics='flow')
+
+        param = pp.Parameters(g)
+        param.set_tensor(solver, perm)
+        param.set_bc(solver, bc)
+        M = solver.matrix(g, {'param': param}).todense()
+
+        # Compare with the pure numpy assembly
+        solver.has_numba = False
+        M_known = solver.matrix(g, {'param': param}).todense()
+
+        assert np.allclose(M, M_known)
+
+#------------------------------------------------------------------------------#
+
+    @unittest.skipUnless('porepy.numerics.fem.cythonp1' in sys.modules,
+                         'Cython extension not available')
+    def test_p1_3d_cython(self):
+
+        g = pp.simplex.StructuredTetrahedralGrid([8, 6, 6], [1, 1, 1])
+        g.nodes += 0.01*np.sin(7*g.nodes)
+        g.compute_geometry()
+
+        kxx = 1+np.square(g.cell_centers[0, :])
+        kxy = -np.multiply(g.cell_centers[0, :], g.cell_centers[1, :])
+        perm = pp.SecondOrderTensor(3, kxx=kxx, kyy=kxx, kzz=1, kxy=kxy)
+
+        bf = g.get_boundary_faces()
+        bc = pp.BoundaryCondition(g, bf, bf.size*['dir'])
+        solver = pp.P1(physics='flow')
+        solver.has_numba = False
+
+        param = pp.Parameters(g)
+        param.set_tensor(solver, perm)
+        param.set_bc(solver, bc)
+        M = solver.matrix(g, {'param': param}).todense()
+
+        # Compare with the pure numpy assembly
+        solver.has_cython = False
+        M_known = solver.matrix(g, {'param': param}).todense()
+
+        assert np.allclose(M, M_known)
+
+#------------------------------------------------------------------------------#
+
+    @unittest.skipUnless(hasattr(p1, 'assemble_stiffH1_cfunc'),
+                         'Numba not available')
+    def test_p1_2d_cfunc(self):
+
+        g = pp.simplex.StructuredTriangleGrid([3, 2], [1, 1])
+        g.compute_geometry()
+
+        nloc = g.cell_nodes().indices.reshape((g.num_cells, g.dim+1))
+        node_coords = np.ascontiguousarray(g.nodes[:g.dim, :].T)
+        K = np.tile(np.array([[2., 1.], [1., 3.]]), (g.num_cells, 1, 1))
+        dataIJ = np.empty(np.power(g.dim+1, 2)*g.num_cells)
+
+        as_double = lambda v: v.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+        assemble = p1.assemble_stiffH1_cfunc(g.dim)
+        assemble.ctypes(g.num_cells, g.num_nodes, as_double(node_coords),
+                        nloc.ctypes.data_as(ctypes.POINTER(ctypes.c_int32)),
+                        as_double(K), as_double(g.cell_volumes),
+                        as_double(dataIJ))
+
+        solver = pp.P1(physics='flow')
+        for c in np.arange(g.num_cells):
+            A = solver.stiffH1(K[c], g.cell_volumes[c],
+                               node_coords[nloc[c]].T, g.dim)
+            assert np.allclose(dataIJ[9*c:9*(c+1)], A.ravel())
+
 #------------------------------------------------------------------------------#
 
     def test_dual_p1_1d_iso_line(self):
@@ -333,6 +422,142 @@ class BasicsTest(unittest.TestCase):
 
             #assert np.isclose(err, 0)
 
+#------------------------------------------------------------------------------#
+
+    def test_p1_2d_reuse_pattern(self):
+        g = pp.simplex.StructuredTriangleGrid([3, 4], [1, 1])
+        g.compute_geometry()
+
+        kxx = np.ones(g.num_cells)
+        perm = pp.SecondOrderTensor(3, kxx=kxx, kyy=kxx, kzz=1)
+        bf = g.get_boundary_faces()
+        bc = pp.BoundaryCondition(g, bf, bf.size*['dir'])
+
+        solver = pp.P1(physics='flow')
+
+        param = pp.Parameters(g)
+        param.set_tensor(solver, perm)
+        param.set_bc(solver, bc)
+        data = {'param': param}
+        M_first = solver.matrix(g, data).todense()
+
+        # Change the permeability, the sparsity pattern is reused
+        kxx = np.square(g.cell_centers[1, :])+1
+        kxy = -np.multiply(g.cell_centers[0, :], g.cell_centers[1, :])
+        perm = pp.SecondOrderTensor(3, kxx=kxx, kyy=kxx, kxy=kxy, kzz=1)
+        param.set_tensor(solver, perm)
+        M = solver.matrix(g, data).todense()
+        M_known = solver.matrix(g, {'param': param}).todense()
+
+        assert np.allclose(M, M_known)
+        assert not np.allclose(M_first, M_known)
+
+#------------------------------------------------------------------------------#
+
+    def test_rhs_2d_reuse_dir_mass(self):
+
+        p_ex = lambda pt: 2*pt[0, :]-3*pt[1, :]-9
+
+        g = pp.simplex.StructuredTriangleGrid([4]*2, [1, 1])
+        g.compute_geometry()
+
+        kxx = np.ones(g.num_cells)
+        perm = pp.SecondOrderTensor(3, kxx=kxx, kyy=kxx, kzz=1)
+        bf = g.get_boundary_faces()
+        bc = pp.BoundaryCondition(g, bf, bf.size*['dir'])
+        bc_val = np.zeros(g.num_faces)
+        bc_val[bf] = 1
+
+        solver = pp.P1(physics='flow')
+
+        param = pp.Parameters(g)
+        param.set_tensor(solver, perm)
+        param.set_bc(solver, bc)
+        param.set_bc_val(solver, bc_val)
+        data = {'param': param}
+        solver.rhs(g, data)
+
+        # Change the boundary values, the factorization of the boundary
+        # mass matrix is reused
+        bc_val[bf] = p_ex(g.face_centers[:, bf])
+        param.set_bc_val(solver, bc_val)
+        rhs = solver.rhs(g, data)
+        rhs_known = solver.rhs(g, {'param': param})
+
+        assert np.allclose(rhs, rhs_known)
+
+#------------------------------------------------------------------------------#
+
+    def test_rhs_2d_reuse_dir_mass_geometry_change(self):
+
+        g = pp.simplex.StructuredTriangleGrid([4]*2, [1, 1])
+        g.compute_geometry()
+
+        kxx = np.ones(g.num_cells)
+        perm = pp.SecondOrderTensor(3, kxx=kxx, kyy=kxx, kzz=1)
+        bf = g.get_boundary_faces()
+        bc = pp.BoundaryCondition(g, bf, bf.size*['dir'])
+        bc_val = np.zeros(g.num_faces)
+        bc_val[bf] = 1 + g.face_centers[0, bf]
+
+        solver = pp.P1(physics='flow')
+
+        param = pp.Parameters(g)
+        param.set_tensor(solver, perm)
+        param.set_bc(solver, bc)
+        param.set_bc_val(solver, bc_val)
+        data = {'param': param}
+        solver.rhs(g, data)
+
+        # Change the geometry, the factorization of the boundary mass matrix
+        # must be recomputed
+        g.nodes[0, :] *= np.square(g.nodes[0, :]) + 1
+        g.compute_geometry()
+        rhs = solver.rhs(g, data)
+        rhs_known = solver.rhs(g, {'param': param})
+
+        assert np.allclose(rhs, rhs_known)
+
+#------------------------------------------------------------------------------#
+
+    def test_coupling_2d_1d_boundary(self):
+
+        g_h = pp.simplex.StructuredTriangleGrid([3, 2], [1, 1])
+        g_h.compute_geometry()
+        g_l = pp.structured.CartGrid(3, 1)
+        g_l.compute_geometry()
+
+        # The mortar grid lies on the bottom boundary of the triangle grid
+        faces = np.where(np.isclose(g_h.face_centers[1], 0))[0]
+        faces = faces[np.argsort(g_h.face_centers[0, faces])]
+        face_cells = sps.csc_matrix((np.ones(faces.size),
+                                     (np.arange(faces.size), faces)),
+                                    shape=(g_l.num_cells, g_h.num_faces))
+        mg = mortar_grid.MortarGrid(1, {mortar_grid.LEFT_SIDE: g_l},
+                                    face_cells)
+
+        # Different aperture in each cell, to detect a wrong face-cell map
+        param_h = pp.Parameters(g_h)
+        param_h.set_aperture(1 + np.arange(g_h.num_cells))
+        data_h = {'param': param_h}
+        data_l = {'param': pp.Parameters(g_l)}
+        kn = 2.
+        data_edge = {'mortar_grid': mg, 'kn': kn}
+
+        coupling = p1.P1Coupling(pp.P1(physics='flow'))
+        cc = coupling.matrix_rhs(0, g_h, g_l, data_h, data_l, data_edge)
+
+        faces_h, cells_h, _ = sps.find(g_h.cell_faces)
+        cells_h = cells_h[np.unique(faces_h, return_index=True)[1]]
+        assert np.array_equal(cells_h[faces], [0, 2, 4])
+
+        hat_P = mg.high_to_mortar_avg()
+        eta = np.divide(1./(2*kn), hat_P*param_h.get_aperture()[cells_h])
+        cc_22_known = sps.diags(eta/mg.cell_volumes)
+
+        assert np.allclose(cc[2, 2].toarray(), cc_22_known.toarray())
+        assert np.allclose(cc[2, 2].toarray(), np.diag([0.75, 0.25, 0.15]))
+
 #------------------------------------------------------------------------------#
 
 